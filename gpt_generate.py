@@ -1,5 +1,8 @@
+from collections import OrderedDict
+
 import torch
 import numpy as np
+from transformers import LogitsProcessor
 
 generate_kwargs = {
     "do_sample": True,
@@ -11,7 +14,7 @@ generate_kwargs = {
 }
 
 
-def hash_input_id(input_id: int):
+def hash_input_id(input_id: int) -> int:
     """
     Hash the input id of the previous token to a PRNG seed.
     :param input_id: the id of the previous token
@@ -31,8 +34,8 @@ def gen_red_list(input_id: int, vocab_size: int, frac_red: float = 0.5):
     :return: The list of tokens to red-list.
     """
     seed = hash_input_id(input_id)
-    np.random.seed(seed)
-    return np.random.choice(vocab_size, size=int(frac_red * vocab_size), replace=False)
+    rng = np.random.RandomState(seed)
+    return rng.choice(vocab_size, size=int(frac_red * vocab_size), replace=False)
 
 
 def gen_red_list_salt(input_id: int, vocab_size: int, salt : int, frac_red: float = 0.5):
@@ -45,8 +48,55 @@ def gen_red_list_salt(input_id: int, vocab_size: int, salt : int, frac_red: floa
     """
     seed_mid = hash_input_id(input_id)
     seed = hash_input_id(seed_mid + salt)
-    np.random.seed(seed)
-    return np.random.choice(vocab_size, size=int(frac_red * vocab_size), replace=False)
+    rng = np.random.RandomState(seed)
+    return rng.choice(vocab_size, size=int(frac_red * vocab_size), replace=False)
+
+
+class RedListLogitsProcessor(LogitsProcessor):
+    """
+    A logits processor that bans the red list of the previous token at every decoding step.
+    The red lists are the ones from `gen_red_list`; they are cached as boolean masks on the device of the logits,
+    keyed by the previous token id, so each distinct token only pays for the red list generation once.
+    """
+    def __init__(self, vocab_size: int, frac_red: float = 0.5, cache_size: int = 1024):
+        """
+        :param vocab_size: The size of the vocabulary.
+        :param frac_red: The fraction of the vocabulary to red-list.
+        :param cache_size: The maximum number of red-list masks to keep.
+        """
+        self.vocab_size = vocab_size
+        self.frac_red = frac_red
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def red_list_mask(self, input_id: int, device):
+        """
+        Get the boolean red-list mask for a given previous token.
+        :param input_id: The input id of the previous token.
+        :param device: The device to put the mask on.
+        :return: A boolean tensor of size `vocab_size` that is True for red-listed tokens.
+        """
+        mask = self._cache.get(input_id)
+        if mask is not None and mask.device == device:
+            self._cache.move_to_end(input_id)
+            return mask
+
+        red_list = torch.from_numpy(gen_red_list(input_id, self.vocab_size, self.frac_red))
+        mask = torch.zeros(self.vocab_size, dtype=torch.bool, device=device)
+        mask[red_list.to(device)] = True
+
+        self._cache[input_id] = mask
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return mask
+
+    def __call__(self, input_ids, scores):
+        # a single device-to-host copy for the previous tokens of the whole batch
+        last_ids = input_ids[:, -1].tolist()
+        for i, last_id in enumerate(last_ids):
+            mask = self.red_list_mask(last_id, scores.device)
+            scores[i].masked_fill_(mask, -float("inf"))
+        return scores
 
 
 def generate_with_seed(model, tokenizer, prompt, logits_processor=None,
@@ -66,8 +116,8 @@ def generate_with_seed(model, tokenizer, prompt, logits_processor=None,
     input_ids = tokenizer.encode(prompt, return_tensors="pt").to(model.device)
 
     if seed is not None:
+        # also seeds every CUDA device
         torch.manual_seed(seed)
-        torch.cuda.manual_seed_all(seed)
 
     sample_outputs = model.generate(
         input_ids,
@@ -1,6 +1,17 @@
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+
+
+def autocast(device, enabled=True):
+    """
+    Autocast to FP16 when enabled and running on a CUDA device, no-op otherwise.
+    :param device: the device the model runs on
+    :param enabled: whether to autocast at all
+    :return: the autocast context manager
+    """
+    return torch.autocast(device_type="cuda", dtype=torch.float16, enabled=enabled and device.type == "cuda")
 
 
 def get_embedding(concept, clip_tokenizer, clip):
@@ -16,10 +27,27 @@ def get_embedding(concept, clip_tokenizer, clip):
         embed = clip.get_text_features(**inputs)
 
         # normalize the embedding to unit length
-        embed = embed / embed.norm(p=2, dim=-1, keepdim=True)
+        embed = F.normalize(embed, p=2, dim=-1)
         return embed
 
 
+def get_embeddings(concepts, clip_tokenizer, clip):
+    """
+    Compute the CLIP embeddings of a list of strings in a single batched forward pass.
+    :param concepts: the list of strings to embed
+    :param clip_tokenizer: the CLIP tokenizer
+    :param clip: the CLIP model
+    :return: the embedding vectors as a numpy array, one row per concept
+    """
+    with torch.inference_mode():
+        inputs = clip_tokenizer(concepts, return_tensors="pt", padding=True, truncation=True).to(clip.device)
+        embeds = clip.get_text_features(**inputs)
+
+        # normalize the embeddings to unit length, exactly as in `get_embedding`
+        embeds = F.normalize(embeds, p=2, dim=-1)
+        return embeds.cpu().float().numpy()
+
+
 def cosine_similarity(image_embeds, text_embeds):
     """
     Compute the cosine similarity between image and text embeddings.
@@ -34,51 +62,64 @@ class MySafetyChecker(nn.Module):
     """
     A safety checker that uses CLIP to check if an image is safe, by comparing the image's embedding to a set of
     precomputed embeddings of bad concepts.
+    The bad concept embeddings are normalized to unit length once at construction, so the forward pass only has to
+    normalize the image embeddings. Embeddings that are only approximately unit length (such as the rows of
+    data/bad_embeddings.npy) are rescaled by this, which shifts their scores slightly; cosines very close to the
+    threshold can therefore be classified differently than with the raw embeddings.
     """
-    def __init__(self, clip, bad_embeddings):
+    def __init__(self, clip, bad_embeddings, compile_image_encoder=False, autocast_fp16=False):
+        """
+        :param clip: the CLIP model
+        :param bad_embeddings: the embeddings of the bad concepts, one row per concept
+        :param compile_image_encoder: whether to compile the image encoder with torch.compile (CUDA graphs, fixed
+            input shapes)
+        :param autocast_fp16: whether to run the image encoder under FP16 autocast on CUDA. This is faster, but it
+            shifts the similarity scores slightly, so images close to the threshold can be classified differently.
+        """
         super().__init__()
         self.dtype = clip.dtype
         self.clip_model = clip
-        self.concept_embeds = bad_embeddings
+        self.autocast_fp16 = autocast_fp16
+
+        self.get_image_features = clip.get_image_features
+        if compile_image_encoder:
+            self.get_image_features = torch.compile(clip.get_image_features, mode="reduce-overhead", dynamic=False)
+
+        concept_embeds = torch.as_tensor(bad_embeddings, dtype=torch.float32, device=clip.device)
+        # a plain attribute rather than a buffer, so that casting the module (e.g. `.half()`) never touches it
+        self.concept_embeds = F.normalize(concept_embeds, p=2, dim=-1)
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def forward(self, clip_input, images):
-        image_embeds = self.clip_model.get_image_features(clip_input)
-        image_embeds = image_embeds / image_embeds.norm(p=2, dim=-1, keepdim=True)
-
-        image_embeds = image_embeds.cpu().float().numpy()
-        sim = cosine_similarity(image_embeds, self.concept_embeds)
-        print("similarity", sim)
-
-        result = []
-        batch_size = image_embeds.shape[0]
-        for i in range(batch_size):
-            result_img = {"concept_scores": {}, "bad_concepts": []}
-
-            for concept_idx in range(len(sim[0])):
-                concept_cos = sim[i][concept_idx]
-                result_img["concept_scores"][concept_idx] = round(concept_cos, 3)
-
-                # if the cosine similarity is above a threshold, the image is considered unsafe
-                if result_img["concept_scores"][concept_idx] > 0.28:
-                    result_img["bad_concepts"].append(concept_idx)
-
-            result.append(result_img)
-
-        has_nsfw_concepts = [len(res["bad_concepts"]) > 0 for res in result]
-
-        for idx, has_nsfw_concept in enumerate(has_nsfw_concepts):
-            if has_nsfw_concept:
-                # black image
-                if isinstance(images, np.ndarray):
-                    images[idx] = np.zeros(images[idx].shape)  
-                elif isinstance(images, torch.Tensor):
-                    images[idx] = torch.zeros_like(images[idx])
-
-        if any(has_nsfw_concepts):
-            print(
-                "Potential **BAD** content was detected in one or more images. A black image will be returned instead."
-                " Try again with a different prompt and/or seed."
-            )
+        with autocast(self.clip_model.device, enabled=self.autocast_fp16):
+            image_embeds = self.get_image_features(clip_input)
+
+        # normalize, compare and threshold in FP32; autocast only covers the encoder
+        image_embeds = F.normalize(image_embeds.float(), p=2, dim=-1)
+
+        # follow the CLIP model if it was moved to another device; this is a no-op otherwise
+        self.concept_embeds = self.concept_embeds.to(image_embeds.device)
+
+        # both sides have unit length, so the cosine similarity is a plain matmul
+        sim = torch.matmul(image_embeds, self.concept_embeds.T)
+
+        # if the cosine similarity is above a threshold, the image is considered unsafe
+        # only the per-image flags are copied back to the host
+        has_nsfw_concepts = (sim.round(decimals=3) > 0.28).any(dim=1).tolist()
+
+        # common case: every image is safe, nothing to black out
+        if not any(has_nsfw_concepts):
+            return images, has_nsfw_concepts
+
+        # black image, zero-filled in place
+        if isinstance(images, np.ndarray):
+            images[np.asarray(has_nsfw_concepts)] = 0
+        elif isinstance(images, torch.Tensor):
+            images[torch.tensor(has_nsfw_concepts, device=images.device)] = 0
+
+        print(
+            "Potential **BAD** content was detected in one or more images. A black image will be returned instead."
+            " Try again with a different prompt and/or seed."
+        )
 
         return images, has_nsfw_concepts